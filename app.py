@@ -1,30 +1,48 @@
 # -*- coding: utf-8 -*-
 import os
 import io
+import codecs
+import functools
+import json
 import sqlite3
+import zipfile
 import hashlib
-from datetime import date, datetime
+import hmac
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
 
 from flask import (
     Flask, request, jsonify, send_from_directory,
-    session, render_template
+    session, render_template, g, Response, stream_with_context
 )
 from openai import OpenAI
 
 from docx import Document as DocxDocument
+from lxml import etree
 from PyPDF2 import PdfReader
+import pymupdf
+from pdf_extract import extract_pdf_page_range
 import openpyxl
+import tiktoken
 import re
 
 # ------------ Config ------------
 
 DATABASE_PATH = "nextgen_ai_teachers_aigrader.db"
 FREE_DAILY_LIMIT = 5  # free plan limit
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "50"))  # per request, all files combined
+LLM_CACHE_TTL_DAYS = int(os.environ.get("LLM_CACHE_TTL_DAYS", "0"))  # 0 = cached grades never expire
+MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "5"))  # parallel grading calls per batch
 
 client = OpenAI()  # uses OPENAI_API_KEY from environment
 
 app = Flask(__name__, static_folder="static", static_url_path="")
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-secret-change-me")  # replace in production
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024  # reject oversized uploads early
+app.config["MAX_FORM_MEMORY_SIZE"] = 500 * 1024  # non-file form fields kept in memory
 
 # ------------ Default Prompt ------------
 
@@ -86,34 +104,83 @@ FORMATTING RULES (VERY IMPORTANT):
 
 If the rubric does not clearly state total points, make a reasonable interpretation, explain it briefly in the first Evidence line of the first criterion, and still follow the same output structure."""
 
-# ------------ Simple SHA256 Password Hashing ------------
+# ------------ Password Hashing ------------
+
+# scrypt cost parameters (n=2**14, r=8 uses ~16MB and ~50ms per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _scrypt(password: str, salt: bytes) -> bytes:
+    return hashlib.scrypt(
+        password.encode("utf-8"), salt=salt,
+        n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32,
+    )
+
 
 def hash_password(password: str) -> str:
     """
-    Hash a password using SHA256.
-    NOTE: This is a simple hash, not salted. Fine for a small demo / local app.
+    Hash a password with salted scrypt.
+    Stored as "<salt hex>$<hash hex>".
     """
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    salt = os.urandom(16)
+    return salt.hex() + "$" + _scrypt(password, salt).hex()
+
+
+def is_legacy_hash(stored_hash: str) -> bool:
+    """
+    True for the old unsalted SHA256 hashes, which have no "$" separator.
+    """
+    return "$" not in stored_hash
 
 
 def verify_password(password: str, stored_hash: str) -> bool:
     """
-    Compare a plain-text password to a SHA256 hash.
+    Compare a plain-text password to a stored hash in constant time.
+    Accepts legacy SHA256 hashes so existing users can still log in.
     """
-    return hash_password(password) == stored_hash
+    if is_legacy_hash(stored_hash):
+        candidate = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(candidate, stored_hash)
+
+    salt_hex, hash_hex = stored_hash.split("$", 1)
+    try:
+        salt = bytes.fromhex(salt_hex)
+    except ValueError:
+        return False
+    return hmac.compare_digest(_scrypt(password, salt).hex(), hash_hex)
 
 # ------------ DB Helpers ------------
 
 def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    Return the sqlite connection for the current app context, opening it on first use.
+    Closed by close_db when the request (or app context) ends.
+    """
+    conn = g.get("_db")
+    if conn is None:
+        conn = g._db = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Safe with WAL: commits no longer fsync every time
+        conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
 
+@app.teardown_appcontext
+def close_db(exception=None):
+    conn = g.pop("_db", None)
+    if conn is not None:
+        conn.close()
+
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
 
+    # WAL lets readers run alongside a writer; the setting persists in the db file
+    cur.execute("PRAGMA journal_mode=WAL")
+
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -135,42 +202,277 @@ def init_db():
         );
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS grade_jobs (
+            batch_id TEXT PRIMARY KEY,      -- OpenAI batch id
+            user_id INTEGER NOT NULL,
+            names TEXT NOT NULL,            -- JSON: custom_id -> submission name
+            status TEXT NOT NULL,           -- last seen OpenAI batch status
+            results TEXT,                   -- JSON results once completed
+            created_at TEXT NOT NULL,       -- ISO timestamp
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,           -- sha256(model | prompt)
+            response TEXT NOT NULL,
+            created_at TEXT NOT NULL        -- ISO timestamp
+        );
+    """)
+
+    # Drop cached responses past their TTL
+    if LLM_CACHE_TTL_DAYS > 0:
+        cutoff = (datetime.utcnow() - timedelta(days=LLM_CACHE_TTL_DAYS)).isoformat()
+        cur.execute("DELETE FROM llm_cache WHERE created_at < ?", (cutoff,))
+
+    # Covering indexes: login and redeem are answered from the index alone
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_email_cover
+        ON users (email, id, password_hash, plan);
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_activation_codes_cover
+        ON activation_codes (code, plan, redeemed_by);
+    """)
+
+    # Refresh planner statistics
+    cur.execute("ANALYZE")
+
     conn.commit()
-    conn.close()
 
 
 # Call at startup
-init_db()
+with app.app_context():
+    init_db()
 
 # ------------ File Text Extraction ------------
 
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+_W_P = f"{_W_NS}p"
+_W_T = f"{_W_NS}t"
+_W_TAB = f"{_W_NS}tab"
+_W_BREAKS = (f"{_W_NS}br", f"{_W_NS}cr")
+# Never read text from these inside a paragraph: nested paragraphs (text boxes),
+# paragraph properties (which hold tab-stop w:tab elements) and fallback copies
+_DOCX_SKIP = (_W_P, f"{_W_NS}pPr", _MC_FALLBACK)
+
+# PDFs with at least this many pages are parsed across PDF_WORKERS processes
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "20"))
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(os.cpu_count() or 1)))
+
+BINARY_EXTENSIONS = {".pdf": "pdf", ".docx": "docx", ".xlsx": "xlsx"}
+TEXT_EXTENSIONS = (".txt", ".cpp", ".java", ".py", ".md", ".xml", ".html", ".json", ".csv")
+
+
+def _iter_docx_paragraphs(element):
+    """
+    Yield every w:p in document order, skipping mc:Fallback copies of content
+    (their mc:Choice twin is already visited).
+    """
+    for child in element:
+        if child.tag == _MC_FALLBACK:
+            continue
+        if child.tag == _W_P:
+            yield child
+        yield from _iter_docx_paragraphs(child)
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    """
+    Paragraph text as python-docx's p.text renders it: w:t text, w:tab as a tab,
+    w:br / w:cr as a newline. Nested paragraphs (text boxes) and paragraph
+    properties are not descended into.
+    """
+    parts = []
+
+    def _walk(element):
+        for child in element:
+            tag = child.tag
+            if tag == _W_T:
+                parts.append(child.text or "")
+            elif tag == _W_TAB:
+                parts.append("\t")
+            elif tag in _W_BREAKS:
+                parts.append("\n")
+            elif tag not in _DOCX_SKIP:
+                _walk(child)
+
+    _walk(paragraph)
+    return "".join(parts)
+
+
+def extract_docx_text(zip_file) -> str:
+    """
+    Read paragraph text straight from word/document.xml with lxml,
+    without building python-docx's Paragraph/Run objects.
+    """
+    with zip_file.open("word/document.xml") as xml_file:
+        tree = etree.parse(xml_file)
+
+    return "\n".join(
+        _docx_paragraph_text(p) for p in _iter_docx_paragraphs(tree.getroot())
+    )
+
+
+_pdf_pool = None
+
+
+def get_pdf_pool():
+    """
+    Process pool for large PDFs, created on first use and kept for the worker's lifetime.
+    Uses "spawn" so children do not inherit sockets, sqlite handles or the gevent hub.
+    """
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pdf_pool
+
+
+def extract_pdf_text(raw: bytes) -> str:
+    """
+    Extract PDF text with MuPDF, splitting large PDFs into page ranges
+    that are parsed in parallel across CPU cores.
+    """
+    global _pdf_pool
+
+    with pymupdf.open(stream=raw, filetype="pdf") as doc:
+        page_count = doc.page_count
+        # Small PDFs: process startup and pickling would cost more than they save
+        if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS < 2:
+            return "\n".join(page.get_text("text") for page in doc)
+
+    chunk = -(-page_count // PDF_WORKERS)
+    try:
+        pool = get_pdf_pool()
+        futures = [
+            pool.submit(extract_pdf_page_range, raw, start, min(start + chunk, page_count))
+            for start in range(0, page_count, chunk)
+        ]
+        return "\n".join(f.result() for f in futures)
+    except BrokenProcessPool:
+        # A worker died; release the broken pool, start a fresh one next time
+        # and finish this file here
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
+        return extract_pdf_page_range(raw, 0, page_count)
+
+
+def looks_like_text(sample: bytes) -> bool:
+    """
+    True if a leading sample of a file is valid UTF-8 without NUL bytes.
+    """
+    if b"\x00" in sample:
+        return False
+    try:
+        # Incremental decode: a multi-byte character cut off at the end is fine
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def sniff_file_type(stream, ext: str):
+    """
+    Work out how to parse an upload from its first bytes, then its name.
+
+    Magic bytes only override the extension when they positively match;
+    otherwise .pdf/.docx/.xlsx keep their parser and anything else is text
+    if it looks like text.
+
+    Returns (kind, zip_file): kind is "empty", "pdf", "docx", "xlsx", "text" or None.
+    For zip-based formats the opened ZipFile is returned so it is only read once;
+    the caller closes it.
+    """
+    sample = stream.read(4096)
+    stream.seek(0)
+
+    if not sample:
+        return "empty", None
+
+    # The PDF spec allows up to 1024 bytes of junk before the header
+    if b"%PDF-" in sample[:1024]:
+        return "pdf", None
+
+    if sample.startswith(b"PK\x03\x04"):
+        try:
+            zip_file = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            zip_file = None
+        if zip_file is not None:
+            names = set(zip_file.namelist())
+            if "word/document.xml" in names:
+                return "docx", zip_file
+            zip_file.close()
+            stream.seek(0)
+            if "xl/workbook.xml" in names:
+                return "xlsx", None
+
+    if ext in BINARY_EXTENSIONS:
+        return BINARY_EXTENSIONS[ext], None
+
+    if ext in TEXT_EXTENSIONS or looks_like_text(sample):
+        return "text", None
+    return None, None
+
+
 def extract_text_from_file(file_storage):
     filename = file_storage.filename or ""
     ext = os.path.splitext(filename)[1].lower()
-    raw = file_storage.read()
-    file_storage.seek(0)
+    # Werkzeug already spooled the upload (to disk when large); read from it
+    # directly instead of copying the whole file into memory up front.
+    stream = file_storage.stream
+    stream.seek(0)
+
+    kind, zip_file = sniff_file_type(stream, ext)
+
+    # Empty upload: skip building any document model
+    if kind == "empty":
+        return ""
 
     # Plain text / code / CSV
-    if ext in [".txt", ".cpp", ".java", ".py", ".md", ".xml", ".html", ".json", ".csv"]:
+    if kind == "text":
         try:
-            return raw.decode("utf-8", errors="ignore")
+            return stream.read().decode("utf-8", errors="ignore")
         except Exception:
             return "[Error decoding text file.]"
 
     # DOCX
-    if ext == ".docx":
+    if kind == "docx":
+        # zip_file is None when only the extension said DOCX
+        if zip_file is not None:
+            try:
+                with zip_file:
+                    return extract_docx_text(zip_file)
+            except Exception:
+                pass
+
+        # Fall back to python-docx's full object model
         try:
-            buffer = io.BytesIO(raw)
-            doc = DocxDocument(buffer)
+            stream.seek(0)
+            doc = DocxDocument(stream)
             return "\n".join(p.text for p in doc.paragraphs)
         except Exception:
             return "[Error reading DOCX file.]"
 
     # PDF
-    if ext == ".pdf":
+    if kind == "pdf":
+        try:
+            # MuPDF needs the bytes in memory
+            return extract_pdf_text(stream.read())
+        except Exception:
+            pass
+
+        # Fall back to PyPDF2 for files MuPDF cannot parse
         try:
-            buffer = io.BytesIO(raw)
-            reader = PdfReader(buffer)
+            stream.seek(0)
+            reader = PdfReader(stream)
             pages = []
             for page in reader.pages:
                 text = page.extract_text() or ""
@@ -180,15 +482,17 @@ def extract_text_from_file(file_storage):
             return "[Error reading PDF file.]"
 
     # XLSX
-    if ext == ".xlsx":
+    if kind == "xlsx":
         try:
-            buffer = io.BytesIO(raw)
-            wb = openpyxl.load_workbook(buffer, data_only=True)
-            sheet = wb.active
-            lines = []
-            for row in sheet.iter_rows(values_only=True):
-                line = "\t".join("" if cell is None else str(cell) for cell in row)
-                lines.append(line)
+            # read_only streams rows instead of building the whole workbook tree
+            wb = openpyxl.load_workbook(stream, data_only=True, read_only=True)
+            try:
+                lines = [
+                    "\t".join(["" if cell is None else str(cell) for cell in row])
+                    for row in wb.active.iter_rows(values_only=True)
+                ]
+            finally:
+                wb.close()
             return "\n".join(lines)
         except Exception:
             return "[Error reading XLSX file.]"
@@ -201,42 +505,356 @@ def extract_text_from_file(file_storage):
 PRIMARY_MODEL = os.environ.get("OPENAI_PRIMARY_MODEL", "gpt-4o")
 FALLBACK_MODEL = os.environ.get("OPENAI_FALLBACK_MODEL", "gpt-4o-mini")
 
-def build_full_prompt(prompt_template: str, rubric_text: str, student_text: str) -> str:
+# Token budgets for text sent to the model (0 disables truncation)
+MAX_RUBRIC_TOKENS = int(os.environ.get("MAX_RUBRIC_TOKENS", "8000"))
+MAX_STUDENT_TOKENS = int(os.environ.get("MAX_STUDENT_TOKENS", "30000"))
+
+# Escaped braces are matched as tokens first, so "{{rubric}}" stays literal
+_TEMPLATE_TOKEN_RE = re.compile(r"\{\{|\}\}|\{rubric\}|\{student\}")
+
+
+@functools.lru_cache(maxsize=64)
+def split_prompt_template(prompt_template: str) -> tuple:
+    """
+    Split a template into literal text and placeholder names, once per template.
+
+    Returns alternating (literal, name, literal, name, ..., literal) parts.
+    Literal "{{" / "}}" are unescaped to match str.format.
+    """
+    parts = []
+    literal = []
+    pos = 0
+    for match in _TEMPLATE_TOKEN_RE.finditer(prompt_template):
+        literal.append(prompt_template[pos:match.start()])
+        token = match.group()
+        if token == "{{":
+            literal.append("{")
+        elif token == "}}":
+            literal.append("}")
+        else:
+            parts.append("".join(literal))
+            parts.append(token[1:-1])
+            literal = []
+        pos = match.end()
+    literal.append(prompt_template[pos:])
+    parts.append("".join(literal))
+    return tuple(parts)
+
+
+_token_encoding = None
+_token_encoding_failed = False
+
+# Rough size of a token, used only when the tokenizer cannot be loaded
+CHARS_PER_TOKEN = 4
+
+
+def get_token_encoding():
+    """
+    Tokenizer for PRIMARY_MODEL, loaded on first use.
+
+    tiktoken downloads its BPE file on first use (no timeout), which can hang
+    on offline hosts; pre-fetch it into TIKTOKEN_CACHE_DIR at build time.
+    After one failed load this returns None for the rest of the process
+    instead of stalling every request on another download attempt.
+    """
+    global _token_encoding, _token_encoding_failed
+    if _token_encoding is None and not _token_encoding_failed:
+        try:
+            try:
+                _token_encoding = tiktoken.encoding_for_model(PRIMARY_MODEL)
+            except KeyError:
+                _token_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            _token_encoding_failed = True
+            app.logger.warning("tiktoken encoding unavailable, using character cap: %s", e)
+    return _token_encoding
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
     """
-    Safely interpolate rubric and student text into the prompt template.
+    Cut text down to max_tokens tokens, marking where it was truncated.
+    Prompt latency and cost grow with input tokens, so huge uploads are capped.
+    Without a tokenizer, falls back to an approximate character cap.
+    """
+    text = text or ""
+    # Every token is at least one byte, so short text cannot be over budget
+    if max_tokens <= 0 or len(text.encode("utf-8")) <= max_tokens:
+        return text
+    encoding = get_token_encoding()
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        return text[:max_chars] + "\n[...truncated...]"
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + "\n[...truncated...]"
+
 
-    Escapes curly braces in the rubric and student text so that str.format
-    does not treat them as formatting placeholders.
+def build_full_prompt(prompt_template: str, rubric_text: str, student_text: str) -> str:
     """
-    def _escape(text: str) -> str:
-        return (text or "").replace("{", "{{").replace("}", "}}")
+    Interpolate rubric and student text into the prompt template.
 
-    return prompt_template.format(
-        rubric=_escape(rubric_text),
-        student=_escape(student_text),
+    Plain concatenation of the pre-split template, so curly braces in the
+    rubric or student text never need escaping. Each text is first capped
+    at its token budget.
+    """
+    values = {
+        "rubric": truncate_to_tokens(rubric_text, MAX_RUBRIC_TOKENS),
+        "student": truncate_to_tokens(student_text, MAX_STUDENT_TOKENS),
+    }
+    parts = split_prompt_template(prompt_template)
+    return "".join(
+        values[part] if i % 2 else part
+        for i, part in enumerate(parts)
     )
 
+
+# Warm the cache for the template used by almost every request
+split_prompt_template(DEFAULT_PROMPT_TEMPLATE)
+
+def llm_cache_key(model_name: str, full_prompt: str) -> str:
+    return hashlib.sha256(f"{model_name}|{full_prompt}".encode("utf-8")).hexdigest()
+
+
+def get_cached_response(key: str):
+    """
+    Return a cached model response, or None on a miss or an expired entry.
+    Only valid because grading always runs at temperature=0.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,))
+    row = cur.fetchone()
+
+    if not row:
+        return None
+    if LLM_CACHE_TTL_DAYS > 0:
+        created_at = datetime.fromisoformat(row["created_at"])
+        if datetime.utcnow() - created_at > timedelta(days=LLM_CACHE_TTL_DAYS):
+            return None
+    return row["response"]
+
+
+def store_cached_response(key: str, response: str) -> None:
+    """
+    Best-effort cache write: a failure (e.g. "database is locked") must not
+    cost the caller the answer it already paid for.
+    """
+    conn = get_db()
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO llm_cache (key, response, created_at)
+            VALUES (?, ?, ?)
+        """, (key, response, datetime.utcnow().isoformat()))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+
+
 def call_model(full_prompt: str) -> str:
     """
     Call OpenAI and return plain text.
-    Uses chat.completions and falls back to a secondary model on error.
+    Uses the shared sync client so single requests reuse its keep-alive connections.
+    Falls back to a secondary model on error; answers repeats from llm_cache.
     """
     last_error = None
     for model_name in (PRIMARY_MODEL, FALLBACK_MODEL):
         if not model_name:
             continue
+        key = llm_cache_key(model_name, full_prompt)
+        cached = get_cached_response(key)
+        if cached is not None:
+            return cached
         try:
             response = client.chat.completions.create(
                 model=model_name,
                 messages=[{"role": "user", "content": full_prompt}],
                 temperature=0.0,
             )
-            return response.choices[0].message.content
+            content = response.choices[0].message.content
         except Exception as e:
             last_error = str(e)
             continue
+        if content:
+            store_cached_response(key, content)
+        return content
     raise RuntimeError(f"OpenAI call failed: {last_error}")
 
+
+def call_models_parallel(prompts, max_concurrency: int = MAX_CONCURRENCY):
+    """
+    Grade several prompts concurrently, at most max_concurrency in flight.
+
+    Threads run the sync call_model, which under gunicorn's gevent worker
+    become cooperative greenlets; each gets its own app context (and sqlite
+    connection). Returns one result per prompt: the text, or the exception raised.
+    """
+    def _one(prompt):
+        with app.app_context():
+            try:
+                return call_model(prompt)
+            except Exception as e:
+                return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(prompts)))) as pool:
+        return list(pool.map(_one, prompts))
+
+
+# One pass over the model output: leading bullets (*, -, +), bold markers and rules.
+# Bullets match first so "***text" loses all its stars; only horizontal
+# whitespace is eaten so the blank lines between criteria survive.
+_CLEAN_RE = re.compile(r"^[*\-+]+[ \t]*|\*\*|---", re.MULTILINE)
+
+
+def clean_model_output(raw_result: str) -> str:
+    """
+    Defensive cleaning in case the model still returns some Markdown-style artifacts.
+    """
+    return _CLEAN_RE.sub("", raw_result or "").strip()
+
+def stream_model(full_prompt: str):
+    """
+    Yield raw text deltas from OpenAI as they are generated.
+    Falls back to the secondary model only if the primary fails before streaming starts.
+    Cached responses are yielded in one piece; completed streams are cached.
+    """
+    last_error = None
+    for model_name in (PRIMARY_MODEL, FALLBACK_MODEL):
+        if not model_name:
+            continue
+        key = llm_cache_key(model_name, full_prompt)
+        cached = get_cached_response(key)
+        if cached is not None:
+            yield cached
+            return
+        try:
+            stream = client.chat.completions.create(
+                model=model_name,
+                messages=[{"role": "user", "content": full_prompt}],
+                temperature=0.0,
+                stream=True,
+            )
+        except Exception as e:
+            last_error = str(e)
+            continue
+
+        pieces = []
+        # Closing the stream aborts the upstream request if the client disconnects
+        with stream:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+
+        content = "".join(pieces)
+        if content:
+            store_cached_response(key, content)
+        return
+    raise RuntimeError(f"OpenAI call failed: {last_error}")
+
+
+def clean_model_stream(deltas):
+    """
+    Incremental clean_model_output: buffers each line until it is complete,
+    cleans it, and holds back blank lines so the result is stripped at both ends.
+    """
+    buffer = ""
+    pending = ""  # whitespace not yet emitted
+    started = False
+
+    def _emit(line):
+        nonlocal pending, started
+        text = _CLEAN_RE.sub("", line)
+        body = text.rstrip()
+        if not body:
+            pending += text
+            return ""
+        if not started:
+            started = True
+            out = body.lstrip()
+        else:
+            out = pending + body
+        pending = text[len(body):]
+        return out
+
+    for delta in deltas:
+        buffer += delta
+        if "\n" not in buffer:
+            continue
+        *lines, buffer = buffer.split("\n")
+        out = ""
+        for line in lines:
+            out += _emit(line)
+            if started:
+                pending += "\n"
+        if out:
+            yield out
+
+    out = _emit(buffer)
+    if out:
+        yield out
+
+# ------------ Batch API ------------
+
+# Batch statuses after which no more output will be produced
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def submit_grading_batch(prompts_by_id: dict) -> str:
+    """
+    Upload prompts as a JSONL file and start an OpenAI batch (50% cheaper, 24h window).
+    Returns the batch id.
+    """
+    lines = []
+    for custom_id, full_prompt in prompts_by_id.items():
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": PRIMARY_MODEL,
+                "messages": [{"role": "user", "content": full_prompt}],
+                "temperature": 0.0,
+            },
+        }))
+    buffer = io.BytesIO("\n".join(lines).encode("utf-8"))
+
+    batch_file = client.files.create(file=("grade_class.jsonl", buffer), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def read_batch_results(file_id: str) -> dict:
+    """
+    Download a batch output or error file and map custom_id -> text or error.
+    """
+    results = {}
+    content = client.files.content(file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        custom_id = item.get("custom_id")
+        response = item.get("response") or {}
+        if response.get("status_code") == 200:
+            body = response.get("body") or {}
+            text = body["choices"][0]["message"]["content"] or ""
+            results[custom_id] = {"result": clean_model_output(text)}
+        else:
+            error = item.get("error") or (response.get("body") or {}).get("error") or "Unknown error"
+            if isinstance(error, dict):
+                error = error.get("message") or str(error)
+            results[custom_id] = {"error": f"Error while calling AI model: {error}"}
+    return results
+
 # ------------ Auth Helpers ------------
 
 def get_current_user():
@@ -247,46 +865,55 @@ def get_current_user():
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 
-def update_user_usage(user_id):
+def update_user_usage(user_id, count=1):
+    """
+    Charge `count` grades to the user in one atomic statement.
+
+    The daily counter resets when last_use_date is not today, and free-plan
+    users are only charged while they stay within FREE_DAILY_LIMIT.
+    Doubles as the login check for grading routes, so they skip get_current_user.
+    Requires sqlite 3.35+ for RETURNING.
+
+    Returns (usage_info, None) on success, or (error_info, 401 / 403).
+    """
     today_str = date.today().isoformat()
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT uses_today, last_use_date, plan FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return {"error": "User not found"}
-
-    uses_today = row["uses_today"] or 0
-    last_use_date = row["last_use_date"]
-    plan = row["plan"]
-
-    if last_use_date != today_str:
-        uses_today = 0
-
-    if plan == "free" and uses_today >= FREE_DAILY_LIMIT:
-        conn.close()
-        return {"error": "Free plan daily limit reached. Upgrade to Pro for unlimited grading."}
-
-    uses_today += 1
     cur.execute("""
-        UPDATE users SET uses_today = ?, last_use_date = ? WHERE id = ?
-    """, (uses_today, today_str, user_id))
+        UPDATE users
+        SET uses_today = CASE WHEN last_use_date = ?1 THEN uses_today + ?4 ELSE ?4 END,
+            last_use_date = ?1
+        WHERE id = ?2
+          AND (plan != 'free'
+               OR CASE WHEN last_use_date = ?1 THEN uses_today ELSE 0 END + ?4 <= ?3)
+        RETURNING plan, uses_today
+    """, (today_str, user_id, FREE_DAILY_LIMIT, count))
+    row = cur.fetchone()
     conn.commit()
-    conn.close()
+
+    if not row:
+        # Only on failure: tell a missing user apart from a reached limit
+        cur.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+        if not cur.fetchone():
+            return {"error": "Login required."}, 401
+        return {"error": "Free plan daily limit reached. Upgrade to Pro for unlimited grading."}, 403
 
     return {
-        "plan": plan,
-        "uses_today": uses_today,
+        "plan": row["plan"],
+        "uses_today": row["uses_today"],
         "limit": FREE_DAILY_LIMIT
-    }
+    }, None
 
 # ------------ Routes ------------
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload too large (max {MAX_UPLOAD_MB} MB)."}), 413
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -317,12 +944,10 @@ def register():
         """, (email, pw_hash))
         conn.commit()
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"error": "Email already registered."}), 400
 
     cur.execute("SELECT id FROM users WHERE email = ?", (email,))
     row = cur.fetchone()
-    conn.close()
 
     session["user_id"] = row["id"]
     return jsonify({"message": "Registered successfully.", "plan": "free"})
@@ -339,13 +964,21 @@ def login():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE email = ?", (email,))
+    # INDEXED BY: sqlite otherwise prefers the UNIQUE(email) index and then reads the row
+    cur.execute("""
+        SELECT id, password_hash, plan FROM users INDEXED BY idx_users_email_cover
+        WHERE email = ?
+    """, (email,))
     row = cur.fetchone()
-    conn.close()
 
     if not row or not verify_password(password, row["password_hash"]):
         return jsonify({"error": "Invalid email or password."}), 400
 
+    # Upgrade legacy SHA256 hashes to scrypt on successful login
+    if is_legacy_hash(row["password_hash"]):
+        cur.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hash_password(password), row["id"]))
+        conn.commit()
+
     session["user_id"] = row["id"]
     return jsonify({
         "message": "Logged in successfully.",
@@ -388,15 +1021,16 @@ def redeem():
 
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM activation_codes WHERE code = ?", (code,))
+    cur.execute("""
+        SELECT plan, redeemed_by FROM activation_codes INDEXED BY idx_activation_codes_cover
+        WHERE code = ?
+    """, (code,))
     code_row = cur.fetchone()
 
     if not code_row:
-        conn.close()
         return jsonify({"error": "Invalid activation code."}), 400
 
     if code_row["redeemed_by"] is not None:
-        conn.close()
         return jsonify({"error": "Code has already been redeemed."}), 400
 
     # Upgrade user plan
@@ -407,12 +1041,62 @@ def redeem():
         WHERE code = ?
     """, (user["id"], datetime.utcnow().isoformat(), code))
     conn.commit()
-    conn.close()
 
     return jsonify({"message": f"Code redeemed! Your plan is now {code_row['plan']}."})
 
 # --- Grading API ---
 
+def read_rubric_from_request() -> str:
+    """
+    Combine the pasted rubric text and the uploaded rubric file, if any.
+    """
+    rubric_text = (request.form.get("rubricText") or "").strip()
+
+    rubric_file = request.files.get("rubricFile")
+    rubric_file_text = ""
+    if rubric_file and getattr(rubric_file, "filename", ""):
+        rubric_file_text = (extract_text_from_file(rubric_file) or "").strip()
+
+    return "\n\n".join(
+        part for part in [rubric_text, rubric_file_text] if part
+    ).strip()
+
+
+def read_student_from_request() -> str:
+    """
+    Combine the pasted student text and the uploaded student file, if any.
+    """
+    student_text = (request.form.get("studentText") or "").strip()
+
+    student_file = request.files.get("studentFile")
+    student_file_text = ""
+    if student_file and getattr(student_file, "filename", ""):
+        student_file_text = (extract_text_from_file(student_file) or "").strip()
+
+    return "\n\n".join(
+        part for part in [student_text, student_file_text] if part
+    ).strip()
+
+
+def read_submissions_from_request():
+    """
+    Collect (name, text) pairs for multi-submission grading.
+
+    Each non-empty "studentText" field and each "studentFiles" upload is one submission.
+    """
+    submissions = []
+    for i, text in enumerate(request.form.getlist("studentText"), start=1):
+        text = (text or "").strip()
+        if text:
+            submissions.append((f"Submission {i}", text))
+    for student_file in request.files.getlist("studentFiles"):
+        if student_file and getattr(student_file, "filename", ""):
+            text = (extract_text_from_file(student_file) or "").strip()
+            if text:
+                submissions.append((student_file.filename, text))
+    return submissions
+
+
 @app.post("/api/grade")
 def grade():
     """
@@ -423,73 +1107,260 @@ def grade():
     - Accepts rubric and student content as text, file upload, or both.
     - Uses a robust prompt that supports any rubric and any file type.
     """
-    user = get_current_user()
-    if not user:
+    user_id = session.get("user_id")
+    if not user_id:
         return jsonify({"error": "Login required."}), 401
 
     # Check and update usage (free vs pro)
-    usage_info = update_user_usage(user["id"])
-    if "error" in usage_info:
+    usage_info, status = update_user_usage(user_id)
+    if status:
         # Daily limit or user issue
-        return jsonify(usage_info), 403
+        return jsonify(usage_info), status
 
-    # Text fields
-    rubric_text = (request.form.get("rubricText") or "").strip()
-    student_text = (request.form.get("studentText") or "").strip()
     prompt_template = (request.form.get("promptTemplate") or "").strip() or DEFAULT_PROMPT_TEMPLATE
 
-    # File uploads
-    rubric_file = request.files.get("rubricFile")
-    student_file = request.files.get("studentFile")
+    # Combine pasted text + file text
+    combined_rubric = read_rubric_from_request()
+    combined_student = read_student_from_request()
 
-    rubric_file_text = ""
-    student_file_text = ""
+    # Basic validation
+    if not combined_rubric:
+        return jsonify({"error": "Rubric is required. Paste rubric text or upload a rubric file."}), 400
 
-    if rubric_file and getattr(rubric_file, "filename", ""):
-        rubric_file_text = (extract_text_from_file(rubric_file) or "").strip()
+    if not combined_student:
+        return jsonify({"error": "Student work is required. Paste student text or upload a student file."}), 400
 
-    if student_file and getattr(student_file, "filename", ""):
-        student_file_text = (extract_text_from_file(student_file) or "").strip()
+    # Build full prompt safely (handles curly braces in rubric or student text)
+    full_prompt = build_full_prompt(prompt_template, combined_rubric, combined_student)
 
-    # Combine pasted text + file text
-    combined_rubric = "\n\n".join(
-        part for part in [rubric_text, rubric_file_text] if part
-    ).strip()
+    try:
+        raw_result = call_model(full_prompt) or ""
+    except Exception as e:
+        return jsonify({"error": f"Error while calling AI model: {e}"}), 500
 
-    combined_student = "\n\n".join(
-        part for part in [student_text, student_file_text] if part
-    ).strip()
+    clean_result = clean_model_output(raw_result)
+
+    return jsonify({
+        "result": clean_result,
+        "plan": usage_info["plan"],
+        "uses_today": usage_info["uses_today"],
+        "limit": usage_info["limit"],
+    })
+
+@app.post("/api/grade_stream")
+def grade_stream():
+    """
+    Same as /api/grade, but streams the cleaned result as plain text while
+    the model generates it.
+
+    - Errors found before grading starts are returned as JSON, like /api/grade.
+    - Usage info is sent in X-Plan, X-Uses-Today and X-Limit headers.
+    - An AI error mid-stream is appended to the text as a bracketed message.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Login required."}), 401
+
+    prompt_template = (request.form.get("promptTemplate") or "").strip() or DEFAULT_PROMPT_TEMPLATE
+    combined_rubric = read_rubric_from_request()
+    combined_student = read_student_from_request()
 
-    # Basic validation
     if not combined_rubric:
         return jsonify({"error": "Rubric is required. Paste rubric text or upload a rubric file."}), 400
 
     if not combined_student:
         return jsonify({"error": "Student work is required. Paste student text or upload a student file."}), 400
 
-    # Build full prompt safely (handles curly braces in rubric or student text)
+    usage_info, status = update_user_usage(user_id)
+    if status:
+        return jsonify(usage_info), status
+
     full_prompt = build_full_prompt(prompt_template, combined_rubric, combined_student)
 
+    # Pull the first delta before responding, so failures before any output
+    # (e.g. both models rejecting the request) return a JSON 500 like /api/grade
+    deltas = stream_model(full_prompt)
     try:
-        raw_result = call_model(full_prompt) or ""
+        first = next(deltas, "")
     except Exception as e:
         return jsonify({"error": f"Error while calling AI model: {e}"}), 500
 
-    # Defensive cleaning in case the model still returns some Markdown-style artifacts
-    clean_result = raw_result.replace("**", "").replace("---", "")
+    def generate():
+        try:
+            yield from clean_model_stream(itertools.chain([first], deltas))
+        except Exception as e:
+            yield f"\n\n[Error while calling AI model: {e}]"
+
+    response = Response(stream_with_context(generate()), mimetype="text/plain")
+    response.headers["X-Plan"] = usage_info["plan"]
+    response.headers["X-Uses-Today"] = str(usage_info["uses_today"])
+    response.headers["X-Limit"] = str(usage_info["limit"])
+    # Stop proxies (e.g. nginx) from buffering the whole stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.post("/api/grade_batch")
+def grade_batch():
+    """
+    Grade several student submissions against one rubric in a single request.
+
+    - Each uploaded "studentFiles" entry and each non-empty "studentText"
+      field is graded as its own submission, concurrently.
+    - Every submission counts toward the free plan daily limit.
+    - A failure on one submission is reported in its entry without failing the rest.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Login required."}), 401
+
+    prompt_template = (request.form.get("promptTemplate") or "").strip() or DEFAULT_PROMPT_TEMPLATE
+    combined_rubric = read_rubric_from_request()
+    if not combined_rubric:
+        return jsonify({"error": "Rubric is required. Paste rubric text or upload a rubric file."}), 400
+
+    submissions = read_submissions_from_request()
+    if not submissions:
+        return jsonify({"error": "Student work is required. Paste student text or upload student files."}), 400
 
-    import re as _re_local
-    clean_result = _re_local.sub(r"^[*\-\+]+\s*", "", clean_result, flags=_re_local.MULTILINE)
-    clean_result = clean_result.strip()
+    usage_info, status = update_user_usage(user_id, count=len(submissions))
+    if status:
+        return jsonify(usage_info), status
+
+    prompts = [
+        build_full_prompt(prompt_template, combined_rubric, text)
+        for _, text in submissions
+    ]
+    try:
+        outputs = call_models_parallel(prompts)
+    except Exception as e:
+        return jsonify({"error": f"Error while calling AI model: {e}"}), 500
+
+    results = []
+    for (name, _), output in zip(submissions, outputs):
+        if isinstance(output, BaseException):
+            results.append({"name": name, "error": f"Error while calling AI model: {output}"})
+        else:
+            results.append({"name": name, "result": clean_model_output(output)})
 
     return jsonify({
-        "result": clean_result,
+        "results": results,
         "plan": usage_info["plan"],
         "uses_today": usage_info["uses_today"],
         "limit": usage_info["limit"],
     })
 
 
+@app.post("/api/grade_class")
+def grade_class():
+    """
+    Queue a whole class for grading through the OpenAI Batch API.
+
+    - Same inputs as /api/grade_batch, but results arrive asynchronously
+      (within 24h, at half the realtime cost).
+    - Returns a batch id; poll /api/grade_class/status/<batch_id> for results.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Login required."}), 401
+
+    prompt_template = (request.form.get("promptTemplate") or "").strip() or DEFAULT_PROMPT_TEMPLATE
+    combined_rubric = read_rubric_from_request()
+    if not combined_rubric:
+        return jsonify({"error": "Rubric is required. Paste rubric text or upload a rubric file."}), 400
+
+    submissions = read_submissions_from_request()
+    if not submissions:
+        return jsonify({"error": "Student work is required. Paste student text or upload student files."}), 400
+
+    usage_info, status = update_user_usage(user_id, count=len(submissions))
+    if status:
+        return jsonify(usage_info), status
+
+    names = {}
+    prompts_by_id = {}
+    for i, (name, text) in enumerate(submissions):
+        custom_id = f"submission-{i}"
+        names[custom_id] = name
+        prompts_by_id[custom_id] = build_full_prompt(prompt_template, combined_rubric, text)
+
+    try:
+        batch_id = submit_grading_batch(prompts_by_id)
+    except Exception as e:
+        return jsonify({"error": f"Error while submitting batch: {e}"}), 500
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO grade_jobs (batch_id, user_id, names, status, created_at)
+        VALUES (?, ?, ?, 'validating', ?)
+    """, (batch_id, user_id, json.dumps(names), datetime.utcnow().isoformat()))
+    conn.commit()
+
+    return jsonify({
+        "batch_id": batch_id,
+        "status": "validating",
+        "plan": usage_info["plan"],
+        "uses_today": usage_info["uses_today"],
+        "limit": usage_info["limit"],
+    })
+
+
+@app.get("/api/grade_class/status/<batch_id>")
+def grade_class_status(batch_id):
+    """
+    Report the status of a class batch, with per-submission results once completed.
+    """
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"error": "Login required."}), 401
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM grade_jobs WHERE batch_id = ? AND user_id = ?", (batch_id, user_id))
+    job = cur.fetchone()
+
+    if not job:
+        return jsonify({"error": "Grading job not found."}), 404
+
+    names = json.loads(job["names"])
+
+    # Results are stored once the batch finishes, so later polls skip OpenAI
+    if job["results"] is not None:
+        return jsonify({"batch_id": batch_id, "status": job["status"], "results": json.loads(job["results"])})
+
+    try:
+        batch = client.batches.retrieve(batch_id)
+        results = None
+        if batch.status in BATCH_FINAL_STATUSES:
+            by_id = {}
+            if batch.error_file_id:
+                by_id.update(read_batch_results(batch.error_file_id))
+            if batch.output_file_id:
+                by_id.update(read_batch_results(batch.output_file_id))
+            results = [
+                {"name": name, **by_id.get(custom_id, {"error": "No result returned."})}
+                for custom_id, name in names.items()
+            ]
+    except Exception as e:
+        return jsonify({"error": f"Error while checking batch: {e}"}), 500
+
+    cur.execute("""
+        UPDATE grade_jobs SET status = ?, results = ? WHERE batch_id = ?
+    """, (batch.status, json.dumps(results) if results is not None else None, batch_id))
+    conn.commit()
+
+    response = {"batch_id": batch_id, "status": batch.status}
+    if results is not None:
+        response["results"] = results
+    return jsonify(response)
+
 
+# Production: gunicorn -k gevent -w 2 --worker-connections 500 app:app (see Procfile)
+# Grading mostly waits on OpenAI, so gevent lets each worker keep hundreds of
+# requests in flight instead of one per sync worker. The OpenAI calls are plain
+# sync calls, made cooperative by gevent's monkey-patching (asyncio.run would
+# clash between greenlets sharing one thread). sqlite queries and scrypt hashing
+# are not patched and still block the worker's hub while they run; both are short.
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+PDF page-range extraction for the process pool in app.py.
+
+Kept free of app imports and side effects: "spawn" workers import this
+module to unpickle the task, so it must not create clients or touch the db.
+"""
+import pymupdf
+
+
+def extract_pdf_page_range(raw: bytes, start: int, stop: int) -> str:
+    """
+    Text of pages [start, stop). Opens its own Document so it can run in a worker process.
+    """
+    with pymupdf.open(stream=raw, filetype="pdf") as doc:
+        return "\n".join(doc.load_page(i).get_text("text") for i in range(start, stop))